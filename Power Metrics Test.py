@@ -4,12 +4,14 @@ import random
 import numpy as np
 import tkinter as tk
 from tkinter import messagebox
-from threading import Thread, Lock
+from threading import Thread
+import queue
 import psutil
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, Future
+from numba import njit, types, uint8, uint32
 
 # ============================ FINAL PROD SPECS ============================
 BASE_SEED = 7
@@ -20,15 +22,43 @@ ROUNDS_PER_INST = 25
 CPU_TDP_WATTS = 25.0    
 FPGA_NOMINAL_MW = 450.0 
 
-ser_lock = Lock()
-
-def cpu_workload(data: bytes):
-    """Calibrated GPT-Stream Software Workload."""
-    result = 0
+tx_q = queue.Queue()
+cpu_load = [0.0]  # latest system load %, refreshed by the background sampler
+
+def cpu_sampler():
+    """Keeps the shared load reading fresh so workers never block on psutil."""
+    while True:
+        cpu_load[0] = psutil.cpu_percent(interval=0.1)
+
+def serial_worker(ser):
+    """Sole owner of the serial port: drains the transmit queue in order."""
+    failure = None
+    while True:
+        item = tx_q.get()
+        if item is None:
+            break
+        data, fut = item
+        if failure is not None:
+            # Port already failed: fail fast so no worker blocks forever
+            fut.set_exception(failure)
+            continue
+        try:
+            ser.write(data)
+            fut.set_result(ser.read(len(data)))
+        except Exception as e:
+            failure = e
+            fut.set_exception(e)
+
+# The payload arrives as a frombuffer view over immutable bytes, so the
+# signature must declare the array readonly or Numba rejects the call.
+@njit(uint32(types.Array(uint8, 1, 'C', readonly=True)), cache=True, fastmath=True)
+def cpu_workload(data):
+    """Calibrated GPT-Stream Software Workload (native-compiled)."""
+    result = np.uint32(0)
     for byte in data:
-        for _ in range(250): 
-            result = (result * 31 + byte) & 0xFFFFFFFF
-            result ^= (result << 13) & 0xFFFFFFFF
+        for _ in range(250):
+            result = np.uint32(result * np.uint32(31) + byte)
+            result ^= np.uint32(result << np.uint32(13))
     return result
 
 class SotaScienceRig:
@@ -57,8 +87,11 @@ class SotaScienceRig:
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.root)
         self.canvas.get_tk_widget().pack(padx=20, pady=10)
         
-        self.heat_buffer = np.zeros((1, 100))
-        self.im = self.ax.imshow(self.heat_buffer, cmap='magma', aspect='auto')
+        self.heat_buffer = np.zeros(100)   # ring buffer of recent load samples
+        self.heat_idx = 0
+        self._disp = np.zeros(100)         # preallocated chronological view
+        self.im = self.ax.imshow(self._disp.reshape(1, 100), cmap='magma', aspect='auto')
+        self.im.set_clim(vmin=0, vmax=35)  # Calibrated for 30% load spikes
         self.ax.set_title("X86_64 THERMAL SILICON PRESSURE (REAL-TIME)", color='#888', fontname="Consolas")
         self.ax.axis('off')
 
@@ -73,6 +106,18 @@ class SotaScienceRig:
         scrollbar.pack(side="right", fill="y")
         self.terminal.config(yscrollcommand=scrollbar.set)
 
+        # --- Coalesced Repaint: workers drop samples here, timer paints ---
+        self._pending = None
+        self.root.after(50, self._flush_ui)
+
+    def _flush_ui(self):
+        # Repaint at most 20 Hz; only the newest sample matters for the HUD
+        # and heatmap, so intermediate samples are intentionally dropped.
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            self.update_live_metrics(*pending)
+        self.root.after(50, self._flush_ui)
+
     def write(self, msg):
         self.terminal.config(state='normal')
         self.terminal.insert(tk.END, f"[{datetime.now().strftime('%H:%M:%S.%f')[:-4]}] {msg}\n")
@@ -80,11 +125,12 @@ class SotaScienceRig:
         self.terminal.config(state='disabled')
 
     def update_live_metrics(self, cpu_w, heat_val, current_bits):
-        # Update Visual Buffer
-        self.heat_buffer = np.roll(self.heat_buffer, -1)
-        self.heat_buffer[0, -1] = heat_val
-        self.im.set_data(self.heat_buffer)
-        self.im.set_clim(vmin=0, vmax=35) # Calibrated for 30% load spikes
+        # Update Visual Buffer: ring-buffer write, then unroll the ring into
+        # the preallocated display buffer (no per-tick allocation or copy churn)
+        self.heat_buffer[self.heat_idx] = heat_val
+        self.heat_idx = (self.heat_idx + 1) % 100
+        np.concatenate((self.heat_buffer[self.heat_idx:], self.heat_buffer[:self.heat_idx]), out=self._disp)
+        self.im.set_data(self._disp.reshape(1, 100))
         self.canvas.draw_idle()
         
         # Update HUD Metrics
@@ -92,7 +138,7 @@ class SotaScienceRig:
         fpga_w = FPGA_NOMINAL_MW / 1000
         self.efficiency.config(text=f"ADVANTAGE: {cpu_w/fpga_w:.2f}x")
 
-def run_instance(idx, ser, ui, stats):
+def run_instance(idx, ui, stats):
     seed = BASE_SEED + idx
     rng = random.Random(seed)
     payloads = [b"GPT_LAYER_ACT", b"NEURAL_W_SYNC", b"SOTA_P_PROBE"]
@@ -102,14 +148,14 @@ def run_instance(idx, ser, ui, stats):
         bits = len(data) * 8
         t_start = time.perf_counter()
         
-        # Baseline CPU Load
-        load = psutil.cpu_percent()
-        cpu_workload(data)
+        # Baseline CPU Load (read from the sampler thread; no syscall here)
+        load = cpu_load[0]
+        cpu_workload(np.frombuffer(data, dtype=np.uint8))
         
-        # Physical FPGA Execution
-        with ser_lock:
-            ser.write(data)
-            ser.read(len(data))
+        # Physical FPGA Execution (round-trip via the dedicated serial thread)
+        fut = Future()
+        tx_q.put((data, fut))
+        fut.result()
         
         t_end = time.perf_counter()
         dur = t_end - t_start
@@ -118,30 +164,38 @@ def run_instance(idx, ser, ui, stats):
         joules = cpu_w * dur
         nj_per_bit = (joules / bits) * 1e9 if bits > 0 else 0
         
-        stats['cpu_watts'].append(cpu_w)
-        stats['nj_bits'].append(nj_per_bit)
-        stats['total_bits'] += bits
+        # Each worker owns its (idx, r) slot, so no lock is needed
+        stats['cpu_watts'][idx, r - 1] = cpu_w
+        stats['nj_bits'][idx, r - 1] = nj_per_bit
+        stats['total_bits'][idx] += bits
         
-        ui.root.after(0, ui.update_live_metrics, cpu_w, load, bits)
+        ui._pending = (cpu_w, load, bits)
         ui.write(f"SEED {seed} | ROUND {r:02} | {bits}b | {nj_per_bit:,.1f} nJ/bit")
 
 def master_controller(ui: SotaScienceRig):
     try:
         ser = serial.Serial(PORT, BAUDRATE, timeout=0.05)
-        stats = {'cpu_watts': [], 'nj_bits': [], 'total_bits': 0}
-        
+        Thread(target=serial_worker, args=(ser,), daemon=True).start()
+        Thread(target=cpu_sampler, daemon=True).start()
+        stats = {
+            'cpu_watts': np.zeros((INSTANCES, ROUNDS_PER_INST)),
+            'nj_bits': np.zeros((INSTANCES, ROUNDS_PER_INST)),
+            'total_bits': np.zeros(INSTANCES, dtype=np.int64)
+        }
+
         ui.write(f"--- COMMENCING PROD BURST: {INSTANCES}x{ROUNDS_PER_INST} ---")
-        
+
         with ThreadPoolExecutor(max_workers=INSTANCES) as executor:
-            futures = [executor.submit(run_instance, i, ser, ui, stats) for i in range(INSTANCES)]
-            while any(f.running() for f in futures):
-                time.sleep(0.1)
+            futures = [executor.submit(run_instance, i, ui, stats) for i in range(INSTANCES)]
+            for f in futures:
+                f.result()  # propagate worker exceptions instead of dropping them
 
+        tx_q.put(None)  # stop the serial thread before releasing the port
         ser.close()
         
         # --- FINAL ACCURATE SUMMARY ---
-        mean_cpu_w = np.mean(stats['cpu_watts'])
-        mean_nj_b = np.mean(stats['nj_bits'])
+        mean_cpu_w = stats['cpu_watts'].mean()
+        mean_nj_b = stats['nj_bits'].mean()
         fpga_w = FPGA_NOMINAL_MW / 1000
         
         # FPGA nJ/bit calculation: Power * Time / Bits
@@ -151,7 +205,7 @@ def master_controller(ui: SotaScienceRig):
         summary = (
             f"FINAL SCIENCE SUMMARY\n"
             f"----------------------------------------\n"
-            f"Total Bits Processed : {stats['total_bits']:,}\n"
+            f"Total Bits Processed : {stats['total_bits'].sum():,}\n"
             f"Mean CPU Power Draw  : {mean_cpu_w:.4f} W\n"
             f"Mean FPGA Power Draw : {fpga_w:.4f} W\n"
             f"CPU Energy Density   : {mean_nj_b:,.2f} nJ/bit\n"